@@ -0,0 +1,19 @@
+"""
+build_kernels.py
+
+Compile the kernels in kernels.py ahead of time into the model_kernels
+extension module. It is run via `python build_kernels.py` and only needs
+to be rerun if kernels.py changes. When the module is present, model.py
+uses it instead of compiling the kernels at startup.
+"""
+
+from numba.pycc import CC
+import kernels
+
+cc = CC('model_kernels')
+
+cc.export('recurse_f8','f8[:,:](f8[:], f8[:], f8[:], f8, f8, f8, f8)')(
+    kernels.recurse)
+
+if __name__ == '__main__':
+    cc.compile()
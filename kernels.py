@@ -0,0 +1,67 @@
+"""
+kernels.py
+
+Numerical kernels for model.py, written as plain Python loops over NumPy
+arrays so they can be compiled by numba. model.py compiles them just in
+time unless build_kernels.py has been used to compile them ahead of time
+into the model_kernels extension module.
+"""
+
+import numpy as np
+
+#=======================================================================
+#  recurse(gamma, td, pk_net, r, delta, w, cap0)
+#
+#  Backward recursion for lambda and forward recursion for capital
+#=======================================================================
+
+def recurse(gamma, td, pk_net, r, delta, w, cap0):
+    """
+    Calculate lambda, investment and capital in every period.
+
+    Parameters
+    ----------
+    gamma : np.ndarray
+        Marginal revenue product of capital in each period.
+    td : np.ndarray
+        Tax rate in each period.
+    pk_net : np.ndarray
+        Price of capital net of the ITC in each period.
+    r, delta, w, cap0 : float
+        Interest rate, depreciation rate, wage and initial capital stock.
+
+    Returns
+    -------
+    np.ndarray
+        A (3,N) array with rows for lambda, investment and capital.
+    """
+
+    N = len(gamma)
+
+    out = np.empty((3,N))
+
+    lam = out[0]
+    inv = out[1]
+    cap = out[2]
+
+    #  Impose the boundary conditions
+
+    lam[N-1] = gamma[N-1]*(1-td[N-1])/(r+delta)
+    cap[0] = cap0
+
+    #  Walk backwards from period N-1 to 0 calculating lambda
+
+    for i in range(N-2,-1,-1):
+        lam[i] = (lam[i+1] + gamma[i]*(1-td[i]))/(1+r+delta)
+
+    #  Calculate investment in all periods given lambda
+
+    for i in range(N):
+        inv[i] = (lam[i]/(1-td[i]) - pk_net[i])/(2*w)
+
+    #  Walk forward from period 0 to N-1 calculating the capital stock
+
+    for i in range(N-1):
+        cap[i+1] = inv[i] + (1-delta)*cap[i]
+
+    return out
@@ -14,9 +14,156 @@ The output files are CSV files with the same stem as the input files.
 import pandas as pd
 import tomllib
 import os
+import tempfile
+import threading
 import numpy as np
+from collections import namedtuple
+from dataclasses import dataclass, fields
 import scipy.optimize as opt
+from scipy.sparse.linalg import LinearOperator
 from quicklog import logger
+import kernels
+
+#  Use the ahead-of-time compiled kernels from build_kernels.py if they
+#  have been built. Otherwise use numba to compile them at run time if
+#  it's available, or fall back to running them as ordinary Python loops
+#  over NumPy arrays.
+
+try:
+    from model_kernels import recurse_f8 as _recurse_kernel
+except ImportError:
+    try:
+        from numba import njit
+    except ImportError:
+        def njit(*args, **kwargs):
+            return lambda func: func
+    _recurse_kernel = njit(cache=True, nogil=True)(
+        kernels.recurse)
+
+#  State for the run being done by the current thread: its iteration
+#  counter and, when runs are done in parallel, a buffer of its log
+#  messages. Reset by run_one(). The class defaults let the evaluation
+#  functions be used outside run_one() with messages going straight to
+#  the main log.
+
+class _RunState(threading.local):
+    n_it = 0
+    buffer = None
+
+    def log(self, *args):
+        if self.buffer is None:
+            ql.log(*args)
+        else:
+            self.buffer.log(*args)
+
+_run = _RunState()
+_log_lock = threading.Lock()
+
+#  Use numexpr for the elementwise arithmetic on long trajectories if
+#  it's available. Below NE_MIN_SIZE periods its call overhead outweighs
+#  the savings and plain NumPy is faster.
+
+try:
+    import numexpr as ne
+except ImportError:
+    ne = None
+
+NE_MIN_SIZE = 100_000
+
+#=======================================================================
+#  _recurse(gamma, td, pk_net, r, delta, w, cap0)
+#
+#  Backward recursion for lambda and forward recursion for capital
+#=======================================================================
+
+def _recurse(gamma, td, pk_net, r, delta, w, cap0):
+    """
+    Calculate lambda, investment and capital in every period.
+
+    Parameters
+    ----------
+    gamma : np.ndarray
+        Marginal revenue product of capital in each period.
+    td : np.ndarray
+        Tax rate in each period.
+    pk_net : np.ndarray
+        Price of capital net of the ITC in each period.
+    r, delta, w, cap0 : float
+        Interest rate, depreciation rate, wage and initial capital stock.
+
+    Returns
+    -------
+    tuple of np.ndarray
+        Arrays of lambda, investment and capital.
+
+    Notes
+    -----
+    The loops themselves are in kernels.recurse. For a batch the arrays
+    are (R,N) and the kernel is called once for each run.
+    """
+
+    if gamma.ndim == 2:
+        out = np.stack([
+            _recurse_kernel(g, t, k, r, delta, w, cap0)
+            for (g, t, k) in zip(gamma, td, pk_net)
+            ],axis=1)
+    else:
+        out = _recurse_kernel(gamma, td, pk_net, r, delta, w, cap0)
+
+    return out[0], out[1], out[2]
+
+#=======================================================================
+#  ModelState
+#
+#  Arrays of results from evaluating the model
+#=======================================================================
+
+@dataclass
+class ModelState:
+    """
+    Results of evaluating the model, one float64 array per variable.
+
+    The fields are in the order the columns appear in the output files.
+    """
+
+    p: np.ndarray
+    p_net: np.ndarray
+    pk_net: np.ndarray
+    gamma: np.ndarray
+    lam_ss: np.ndarray
+    inv_ss: np.ndarray
+    cap_ss: np.ndarray
+    lam: np.ndarray
+    cap: np.ndarray
+    inv: np.ndarray
+    q: np.ndarray
+    rev_ptc: np.ndarray
+    rev_itc: np.ndarray
+    p_market: np.ndarray
+    p_diff: np.ndarray
+
+    def to_frame(self, exo: pd.DataFrame) -> pd.DataFrame:
+        """
+        Build a dataframe of the exogenous variables and these results.
+
+        Parameters
+        ----------
+        exo : pd.DataFrame
+            A dataframe of exogenous variables indexed by period.
+
+        Returns
+        -------
+        pd.DataFrame
+            A dataframe with the exogenous variables as they were read,
+            followed by a float64 column for each field.
+        """
+
+        cols = {f.name:getattr(self,f.name) for f in fields(self)}
+        res = pd.DataFrame(cols,index=exo.index)
+
+        assert (res.dtypes == np.float64).all()
+
+        return pd.concat([exo,res],axis=1)
 
 #=======================================================================
 #  evaluate(p, exo, pars)
@@ -24,14 +171,14 @@ from quicklog import logger
 #  Evaluate the model for a given guess of the full price trajectory.
 #=======================================================================
 
-def evaluate(p: pd.Series, exo: pd.DataFrame, pars: dict) -> pd.DataFrame:
+def evaluate(p: np.ndarray, exo: pd.DataFrame, pars: dict) -> pd.DataFrame:
     """
     Evaluate the model for a given guess of prices.
 
     Parameters
     ----------
-    p : pd.Series
-        A series of prices indexed by period.
+    p : np.ndarray
+        An array of prices for each period.
     exo : pd.DataFrame
         A dataframe of exogenous variables indexed by period.
     pars : dict
@@ -52,111 +199,372 @@ def evaluate(p: pd.Series, exo: pd.DataFrame, pars: dict) -> pd.DataFrame:
     based on demand elasticity to find the market price.
     """
 
-    global n_it
-    n_it += 1
+    _log_guess(p)
+
+    r     = pars['r']
+    delta = pars['delta']
+    pk    = pars['pk']
+
+    #  Solve the model for these prices
+
+    ctx = precompute(exo,pars)
+    step = _price_step(p,ctx,pars)
+
+    gamma = step.gamma
+
+    #  Calculate the steady state values
+
+    lam_ss = gamma*ctx.one_minus_td/(r+delta)
+    inv_ss = (gamma/(r+delta) - ctx.pk_net)*ctx.inv_denom
+    cap_ss = inv_ss/delta
+
+    #  Calculate the revenue spent on tax credits
+
+    rev_ptc = ctx.sub*p*step.q
+    rev_itc = ctx.itc*pk*step.inv
+
+    state = ModelState(
+        p=p, p_net=step.p_net, pk_net=ctx.pk_net, gamma=gamma,
+        lam_ss=lam_ss, inv_ss=inv_ss, cap_ss=cap_ss,
+        lam=step.lam, cap=step.cap, inv=step.inv, q=step.q,
+        rev_ptc=rev_ptc, rev_itc=rev_itc,
+        p_market=step.p_market, p_diff=step.p_market - p,
+        )
+
+    #  Return the result as a dataframe that includes all of the
+    #  exogenous variables
+
+    return state.to_frame(exo)
+
+#=======================================================================
+#  exo_arrays(exo)
+#
+#  Extract the exogenous variables as contiguous float arrays
+#=======================================================================
+
+def exo_arrays(exo: pd.DataFrame) -> dict:
+    """
+    Extract the exogenous variables needed by the solver as arrays.
+
+    Parameters
+    ----------
+    exo : pd.DataFrame
+        A dataframe of exogenous variables indexed by period.
+
+    Returns
+    -------
+    dict
+        A dictionary of float64 arrays for 'a', 'td', 'sub' and 'itc'.
+    """
+
+    return {k:np.ascontiguousarray(exo[k].to_numpy(dtype=np.float64))
+            for k in ['a','td','sub','itc']}
+
+#=======================================================================
+#  precompute(exo, pars)
+#
+#  Calculate everything the solver needs that doesn't depend on prices
+#=======================================================================
+
+Context = namedtuple('Context',[
+    'sub', 'itc', 'one_plus_sub', 'pk_net', 'a_sq_over_4w', 'a_sq_over_2w',
+    'td', 'one_minus_td', 'inv_denom', 'disc',
+    ])
+
+def precompute(exo: pd.DataFrame, pars: dict) -> Context:
+    """
+    Precompute the price-independent parts of the model for one run.
+
+    Parameters
+    ----------
+    exo : pd.DataFrame
+        A dataframe of exogenous variables indexed by period.
+    pars : dict
+        A dictionary of parameters.
 
-    #  Get parameters from the pars dictionary
+    Returns
+    -------
+    Context
+        A namedtuple of float64 arrays and constants that stay fixed
+        while the solver iterates on prices.
+    """
+
+    return _context(exo_arrays(exo),pars)
+
+def _context(X: dict, pars: dict) -> Context:
+    """
+    Build a Context from a dictionary of exogenous arrays.
+
+    The arrays can be 1-D for a single run or (R,N) for a batch of runs.
+    """
 
     r     = pars['r']
     delta = pars['delta']
     w     = pars['w']
     pk    = pars['pk']
+
+    a_sq = X['a']*X['a']
+
+    return Context(
+        sub          = X['sub'],
+        itc          = X['itc'],
+        one_plus_sub = 1+X['sub'],
+        pk_net       = pk*(1-X['itc']),
+        a_sq_over_4w = a_sq/(4*w),
+        a_sq_over_2w = a_sq/(2*w),
+        td           = X['td'],
+        one_minus_td = 1-X['td'],
+        inv_denom    = 1/(2*w),
+        disc         = 1/(1+r+delta),
+        )
+
+#=======================================================================
+#  _price_step(p, ctx, pars)
+#
+#  The price-dependent part of the model
+#=======================================================================
+
+PriceStep = namedtuple('PriceStep',[
+    'p_net', 'gamma', 'lam', 'inv', 'cap', 'q', 'p_market',
+    ])
+
+def _price_step(p: np.ndarray, ctx: Context, pars: dict) -> PriceStep:
+    """
+    Evaluate everything in the model that depends on prices.
+
+    Parameters
+    ----------
+    p : np.ndarray
+        An array of prices for each period.
+    ctx : Context
+        Price-independent values from precompute().
+    pars : dict
+        A dictionary of parameters.
+
+    Returns
+    -------
+    PriceStep
+        A namedtuple of arrays for the net price, gamma, lambda,
+        investment, capital, output and the market price.
+
+    Notes
+    -----
+    This is the one place the model's equations are written out. All of
+    the other evaluation functions are built on it.
+    """
+
+    r     = pars['r']
+    delta = pars['delta']
+    w     = pars['w']
     cap0  = pars['cap0']
     elast = pars['elast']
     scale = pars['scale']
 
-    #  Log the starting and ending prices unless they are the same
+    #  For long trajectories use numexpr to evaluate each of the
+    #  intra-temporal expressions in a single pass
 
-    p1 = p.iloc[0]
-    pN = p.iloc[-1]
+    fuse = ne is not None and p.size >= NE_MIN_SIZE
 
-    if p1 != pN:
-        ql.log(f'Guess {n_it}',f'{p1} to {pN}')
+    env = {
+        'p':p, 'ops':ctx.one_plus_sub,
+        'a4w':ctx.a_sq_over_4w, 'a2w':ctx.a_sq_over_2w,
+        'scale':float(scale), 'elast':float(elast),
+        }
 
-    #  Crash if there are any missing values
+    #  Intra-temporal results
 
-    assert any(p.isna()) == False
+    if fuse:
+        p_net = ne.evaluate('p*ops',local_dict=env)
+        env['pn'] = p_net
+        gamma = ne.evaluate('pn*pn*a4w',local_dict=env)
+    else:
+        p_net = p*ctx.one_plus_sub
+        gamma = p_net*p_net*ctx.a_sq_over_4w
 
-    #  Start building a dataframe of results. Include all of the exogenous
-    #  variables.
+    #  Recursions for lambda, investment and capital
 
-    d = exo.copy()
+    (lam, inv, cap) = _recurse(gamma, ctx.td, ctx.pk_net,
+                               float(r), float(delta), float(w), float(cap0))
 
-    #  Add the price guess
+    #  Output and market price
 
-    d['p'] = p
+    if fuse:
+        env['cap'] = cap
+        q = ne.evaluate('pn*cap*a2w',local_dict=env)
+        env['q'] = q
+        p_market = ne.evaluate('(q/scale)**(1/elast)',local_dict=env)
+    else:
+        q = p_net*cap*ctx.a_sq_over_2w
+        p_market = (q/scale)**(1/elast)
 
-    #  Evaluate some purely intra-temporal results
+    return PriceStep(p_net, gamma, lam, inv, cap, q, p_market)
 
-    d['p_net'] = p*(1+d['sub'])
-    d['pk_net'] = pk*(1-d['itc'])
+#=======================================================================
+#  _log_guess(p)
+#
+#  Count model evaluations and log the price guess
+#=======================================================================
 
-    d['gamma'] = (d['p_net']**2 * d['a']**2)/(4*w)
+def _log_guess(p: np.ndarray) -> None:
+    """
+    Count an evaluation of the model and log the starting and ending
+    prices of the guess unless they are the same.
+    """
 
-    #  Calculate the steady state values
+    _run.n_it += 1
 
-    d['lam_ss'] = d['gamma']*(1-d['td'])/(r+delta)
-    d['inv_ss'] = (d['gamma']/(r+delta) - d['pk_net'])/(2*w)
-    d['cap_ss'] = d['inv_ss']/delta
+    if p[0] != p[-1]:
+        _run.log(f'Guess {_run.n_it}',f'{p[0]} to {p[-1]}')
 
-    #  Set up information for backward iteration
+#=======================================================================
+#  evaluate_given(p, ctx, pars)
+#
+#  Calculate only the miss distances for a price trajectory
+#=======================================================================
 
-    years = sorted(d.index)
-    first_yr = min(years)
-    last_yr = max(years)
+def evaluate_given(p: np.ndarray, ctx: Context, pars: dict) -> np.ndarray:
+    """
+    Evaluate the model for a given guess of prices and return p_diff.
 
-    d['lam'] = None
-    d['cap'] = None
+    Parameters
+    ----------
+    p : np.ndarray
+        An array of prices for each period.
+    ctx : Context
+        Price-independent values from precompute().
+    pars : dict
+        A dictionary of parameters.
 
-    #  Impose the boundary conditions
+    Returns
+    -------
+    np.ndarray
+        The difference between the market price and the guessed price
+        in each period.
 
-    d.at[last_yr ,'lam'] = d.at[last_yr,'lam_ss']
-    d.at[first_yr,'cap'] = cap0
+    Notes
+    -----
+    This is the solver's version of evaluate(). It uses the same
+    _price_step() but skips everything not needed for p_diff and never
+    builds a dataframe.
+    """
 
-    #  Walk backwards from period N-1 to 0 calculating lambda
+    _log_guess(p)
 
-    rev_years = sorted(years[:-1],reverse=True)
+    return _price_step(p,ctx,pars).p_market - p
 
-    for y in rev_years:
-        next_lam = d.at[y+1,'lam']
-        this_lam = (next_lam + d.at[y,'gamma']*(1-d.at[y,'td']))/(1+r+delta)
-        d.at[y,'lam'] = this_lam
+#=======================================================================
+#  _jacobian(p, ctx, pars)
+#
+#  Analytic derivatives of the miss distances with respect to prices
+#=======================================================================
 
-    #  Calculate investment in all periods given lambda
+def _jacobian(p: np.ndarray, ctx: Context, pars: dict) -> tuple:
+    """
+    Calculate the miss distances and their Jacobian.
 
-    d['inv'] = (d['lam']/(1-d['td'])-d['pk_net'])/(2*w)
+    Parameters
+    ----------
+    p : np.ndarray
+        An array of prices for each period.
+    ctx : Context
+        Price-independent values from precompute().
+    pars : dict
+        A dictionary of parameters.
 
-    #  Walk forward from period 0 to N-1 calculating the capital stock
+    Returns
+    -------
+    tuple
+        The array of miss distances, p_market - p, and an (N,N) array
+        where element [t,s] is the derivative of p_diff in period t with
+        respect to the price in period s.
 
-    for y in years[:-1]:
-        this_cap = d.at[y,'cap']
-        this_inv = d.at[y,'inv']
-        next_cap = this_inv + (1-delta)*this_cap
-        d.at[y+1,'cap'] = next_cap
+    Notes
+    -----
+    A price change in period s affects lambda in s and all earlier
+    periods, discounted by 1/(1+r+delta) per period. That changes
+    investment in those periods, and the capital stock in every period
+    after them, depreciating at rate delta. Output in period t then
+    depends on its own price directly and on all prices through the
+    capital stock.
+    """
 
-    #  Calculate output and the revenue spent on tax credits
+    r     = pars['r']
+    delta = pars['delta']
+    elast = pars['elast']
+
+    N = len(p)
+
+    #  Levels needed for the derivatives
+
+    step = _price_step(p,ctx,pars)
+
+    (p_net, cap, q, p_market) = (step.p_net, step.cap, step.q, step.p_market)
+
+    #  Direct effect of each period's price on that period's lambda
+
+    dgamma = 2*p_net*ctx.one_plus_sub*ctx.a_sq_over_4w
 
-    d['q'] = d['p_net'] * d['a']**2 * d['cap']/(2*w)
+    own = dgamma*ctx.one_minus_td*ctx.disc
+    own[-1] = dgamma[-1]*ctx.one_minus_td[-1]/(r+delta)
 
-    d['rev_ptc'] = d['sub']*p*d['q']
-    d['rev_itc'] = d['itc']*pk*d['inv']
+    #  Lambda in t depends on prices in s >= t with geometric discounting
 
-    #  Use demand elasticity to calculate p_market
+    lag = np.subtract.outer(np.arange(N),np.arange(N))
 
-    d['p_market'] = (d['q']/scale)**(1/elast)
-    d['p_diff'] = d['p_market'] - p
+    dlam = np.where(lag <= 0, ctx.disc**(-lag), 0)*own[None,:]
 
-    #  Return the result
+    dinv = dlam/ctx.one_minus_td[:,None]*ctx.inv_denom
 
-    return d
+    #  Capital in t accumulates investment from periods before t
+
+    dcap = np.where(lag > 0, (1-delta)**(lag-1), 0) @ dinv
+
+    #  Output and the market price
+
+    dq = ctx.a_sq_over_2w[:,None]*(p_net[:,None]*dcap
+                                   + np.diag(ctx.one_plus_sub*cap))
+
+    jac = (p_market/(elast*q))[:,None]*dq - np.eye(N)
+
+    return p_market - p, jac
 
 #=======================================================================
-#  miss_all(p_guess, exo, pars)
+#  miss_all_jac(p_guess, ctx, pars)
+#
+#  Miss distances for all periods along with their Jacobian
+#=======================================================================
+
+def miss_all_jac(p_guess: np.ndarray, ctx, pars) -> tuple:
+    """
+    Calculate the miss distances and their Jacobian for a price guess.
+
+    Parameters
+    ----------
+    p_guess : np.ndarray
+        An array of guessed prices for each period.
+    ctx : Context
+        Price-independent values from precompute().
+    pars : dict
+        A dictionary of parameters.
+
+    Returns
+    -------
+    tuple
+        The array of miss distances and the (N,N) Jacobian, in the form
+        expected by opt.root when jac=True.
+    """
+
+    _log_guess(p_guess)
+
+    return _jacobian(p_guess, ctx, pars)
+
+#=======================================================================
+#  miss_all(p_guess, ctx, pars)
 #
 #  Calculate miss distances for all periods
 #=======================================================================
 
-def miss_all(p_guess: np.ndarray, exo, pars) -> np.ndarray:
+def miss_all(p_guess: np.ndarray, ctx, pars) -> np.ndarray:
     """
     Calculate the miss distances for a given guess of the price.
 
@@ -168,8 +576,8 @@ def miss_all(p_guess: np.ndarray, exo, pars) -> np.ndarray:
     ----------
     p_guess : np.ndarray
         An array of guessed prices for each period.
-    exo : pd.DataFrame
-        A dataframe of exogenous variables indexed by period.
+    ctx : Context
+        Price-independent values from precompute().
     pars : dict
         A dictionary of parameters.
 
@@ -181,23 +589,20 @@ def miss_all(p_guess: np.ndarray, exo, pars) -> np.ndarray:
 
     Notes
     -----
-    This function uses the evaluate function to compute the model results
-    for the guessed prices and then extracts the 'p_diff' column, which
-    represents the difference between the market price and the guessed price.
+    This function uses evaluate_given to compute the difference between
+    the market price and the guessed price without building the full
+    dataframe of results.
     """
 
-    p = pd.Series(p_guess)
-    res = evaluate(p, exo, pars)
-
-    return res['p_diff']
+    return evaluate_given(p_guess, ctx, pars)
 
 #=======================================================================
-#  miss_one(p_guess, exo, pars)
+#  miss_one(p_guess, ctx, pars)
 #
 #  Calculate a single miss distance for just period 0
 #=======================================================================
 
-def miss_one(p_guess, exo, pars) -> np.ndarray:
+def miss_one(p_guess, ctx, pars) -> np.ndarray:
     """
     Calculate the miss distances for a given guess of the price.
 
@@ -209,8 +614,8 @@ def miss_one(p_guess, exo, pars) -> np.ndarray:
     ----------
     p_guess : np.ndarray
         An array of guessed prices for period 0.
-    exo : pd.DataFrame
-        A dataframe of exogenous variables indexed by period.
+    ctx : Context
+        Price-independent values from precompute().
     pars : dict
         A dictionary of parameters.
 
@@ -226,81 +631,410 @@ def miss_one(p_guess, exo, pars) -> np.ndarray:
     where only the first period's price is adjusted based on the guess.
     """
 
-    p = pd.Series(index=exo.index,data=p_guess[0])
-    res = evaluate(p, exo, pars)
+    p = np.full(len(ctx.td), p_guess[0])
 
-    return res.at[0,'p_diff']
+    return evaluate_given(p, ctx, pars)[0]
 
 #=======================================================================
-#  Main program
+#  DiagPreconditioner
+#
+#  Diagonal approximation to the inverse Jacobian for Newton-Krylov
 #=======================================================================
 
-#
-#  Read configuration information
-#
+class DiagPreconditioner(LinearOperator):
+    """
+    Approximate inverse Jacobian built from the own-period derivatives.
 
-with open("model.toml", "rb") as f:
+    Each period's miss distance is differentiated with respect to its
+    own price holding the capital stock fixed, giving the diagonal
+    p_market/(elast*p) - 1. Since p_diff = p_market - p, the diagonal
+    can be recalculated from the solver's current point and residual
+    without evaluating the model again.
 
-    #  Read the configuration file
+    Parameters
+    ----------
+    x : np.ndarray
+        The initial price guess.
+    f : np.ndarray
+        The miss distances at the initial guess.
+    pars : dict
+        A dictionary of parameters.
+    """
 
-    info = tomllib.load(f)
+    def __init__(self, x: np.ndarray, f: np.ndarray, pars: dict):
+        super().__init__(dtype=np.float64,shape=(len(x),len(x)))
+        self.elast = pars['elast']
+        self.update(x,f)
 
-    #  Copy parameters to a new dictionary to keep name space clean
+    def update(self, x, f):
+        self.jdiag = (f+x)/(self.elast*x) - 1
 
-    par_names = ['r','delta','w','pk','elast','scale']
-    pars = {k:info[k] for k in par_names}
+    def _matvec(self, v):
+        return np.ravel(v)/self.jdiag
 
-    #  Get variables
+#=======================================================================
+#  solve_one(ctx, pars, p0)
+#
+#  Scalar Newton solver for the inertial case
+#=======================================================================
 
-    p0 = info['p']
-    cap0 = info['cap0']
+def solve_one(ctx: Context, pars: dict, p0: float, tol: float=1e-10,
+              max_it: int=50) -> opt.OptimizeResult:
+    """
+    Solve for the constant price that clears the market in period 0.
 
-    #  Get run controls
+    Parameters
+    ----------
+    ctx : Context
+        Price-independent values from precompute().
+    pars : dict
+        A dictionary of parameters.
+    p0 : float
+        Initial guess for the price.
+    tol : float
+        Largest acceptable absolute miss distance.
+    max_it : int
+        Maximum number of Newton steps.
 
-    endog_p   = info['endog_p']
-    base_only = info['base_only']
-    force     = info['force']
+    Returns
+    -------
+    opt.OptimizeResult
+        The solution with the same x, fun, success and nfev attributes
+        that opt.root would provide.
 
-    roll = info['roll']
-    inertial = info['inertial']
+    Notes
+    -----
+    The inertial problem has a single unknown, so this uses Newton's
+    method with a one-sided finite difference for the derivative rather
+    than going through opt.root.
+    """
 
-    #  Files and directories
+    x = float(p0)
+    fx = miss_one([x], ctx, pars)
+    nfev = 1
 
-    idir  = info['in']
+    for it in range(max_it):
 
-    if endog_p:
-        odir = info['out_en']
-        logname = 'model-en.log'
-    else:
-        odir = info['out_ex']
-        logname = 'model-ex.log'
+        if abs(fx) < tol:
+            break
+
+        h = 1e-7*max(1.0,abs(x))
+        fprime = (miss_one([x+h], ctx, pars) - fx)/h
+
+        x = x - fx/fprime
+        fx = miss_one([x], ctx, pars)
+        nfev += 2
+
+    return opt.OptimizeResult(x=np.array([x]), fun=fx,
+                              success=bool(abs(fx) < tol), nfev=nfev)
 
+#=======================================================================
+#  evaluate_batch(P, EXO, pars)
 #
-#  Start the logger
+#  Evaluate the model for a batch of independent simulations at once.
+#=======================================================================
+
+def evaluate_batch(P: np.ndarray, EXO: dict, pars: dict) -> dict:
+    """
+    Evaluate the model for a batch of runs that share parameters.
+
+    Parameters
+    ----------
+    P : np.ndarray
+        An (R,N) array of price guesses with one row per run.
+    EXO : dict
+        A dictionary of (R,N) arrays of exogenous variables: 'a', 'td',
+        'sub' and 'itc'.
+    pars : dict
+        A dictionary of parameters.
+
+    Returns
+    -------
+    dict
+        A dictionary of (R,N) arrays of results, including 'p_market'
+        and 'p_diff'.
+
+    Notes
+    -----
+    This uses the same _context() and _price_step() as the single-run
+    functions, applied to whole rows of runs at a time.
+    """
+
+    step = _price_step(P,_context(EXO,pars),pars)
+
+    return {
+        'lam':step.lam, 'inv':step.inv, 'cap':step.cap, 'q':step.q,
+        'p_market':step.p_market, 'p_diff':step.p_market - P,
+        }
+
+#=======================================================================
+#  solve_batch(exos, pars, p0)
 #
+#  Solve a batch of independent simulations with a damped Newton method
+#=======================================================================
 
-ql = logger(logname)
+def solve_batch(exos: list, pars: dict, p0: float,
+                damp: float=0.5, tol: float=1e-10,
+                max_it: int=500) -> tuple:
+    """
+    Solve several simulations at once for their price trajectories.
 
-ql.log('Endogenous price',endog_p)
+    Parameters
+    ----------
+    exos : list
+        A list of dataframes of exogenous variables, all with the same
+        periods.
+    pars : dict
+        A dictionary of parameters.
+    p0 : float
+        Initial guess for the price.
+    damp : float
+        Fraction of the Newton step to take on each iteration.
+    tol : float
+        Largest acceptable absolute miss distance.
+    max_it : int
+        Maximum number of iterations.
 
+    Returns
+    -------
+    tuple
+        An (R,N) array of prices, an (R,N) array of miss distances, and
+        a boolean array indicating which runs converged.
+
+    Notes
+    -----
+    Each period's step uses only the derivative of that period's miss
+    distance with respect to its own price, holding the capital stock
+    fixed: p_market/(elast*p) - 1. Damping covers the cross-period
+    effects that this leaves out.
+    """
+
+    elast = pars['elast']
+
+    if not all(e.index.equals(exos[0].index) for e in exos):
+        raise ValueError('all runs in a batch must have the same periods')
+
+    arrays = [exo_arrays(e) for e in exos]
+    EXO = {k:np.vstack([x[k] for x in arrays]) for k in arrays[0]}
+
+    P = np.full(EXO['a'].shape,float(p0))
+
+    for n_batch in range(max_it):
+
+        res = evaluate_batch(P,EXO,pars)
+        F = res['p_diff']
+
+        done = np.abs(F).max(axis=1) < tol
+        if done.all():
+            break
+
+        #  Only move the runs that haven't converged
+
+        jdiag = res['p_market']/(elast*P) - 1
+        step = np.where(done[:,None], 0, F/jdiag)
+
+        P = P - damp*step
+
+    ql.log('Batch iterations',n_batch+1)
+    ql.log('Batch runs not converged',int((~done).sum()))
+
+    return P, F, done
+
+#=======================================================================
+#  read_exo(i_name)
 #
-#  Look for spreadsheets defining simulations. Only try to use files
-#  with names beginning with "r" and ending with ".xlsx". If base_only
-#  is set, only use the baseline file
+#  Read a simulation definition, using a cached binary copy if possible
+#=======================================================================
+
+def read_exo(i_name: str) -> pd.DataFrame:
+    """
+    Read the exogenous variables for a simulation.
+
+    Parameters
+    ----------
+    i_name : str
+        Path to the input spreadsheet.
+
+    Returns
+    -------
+    pd.DataFrame
+        A dataframe of exogenous variables indexed by period.
+
+    Notes
+    -----
+    Parsing Excel files is slow, so the first time a spreadsheet is read
+    a copy is saved as a feather file in a cache subdirectory next to it.
+    Later runs read the cached copy unless the spreadsheet has been
+    modified since. If pyarrow isn't available or the cached copy can't
+    be read, the spreadsheet is read directly. Periods must be
+    consecutive and in order.
+    """
+
+    (idir,f) = os.path.split(i_name)
+    stem = os.path.splitext(f)[0]
+
+    cdir = os.path.join(idir,'cache')
+    c_name = os.path.join(cdir,f'{stem}.feather')
+
+    #  Use the cached copy if it's current. Any problem reading it, such
+    #  as pyarrow not being installed or a damaged file, is treated as a
+    #  cache miss.
+
+    exo = None
+
+    if os.path.exists(c_name) and \
+       os.path.getmtime(c_name) >= os.path.getmtime(i_name):
+        try:
+            exo = pd.read_feather(c_name).set_index('period')
+        except Exception as e:
+            _run.log('Ignoring unreadable cache file',f'{c_name}: {e}')
+
+    if exo is None:
+
+        exo = pd.read_excel(i_name, index_col='period')
+
+        #  Write the cache to a temporary file and then move it into
+        #  place so an interrupted write can't leave a partial file
+        #  behind under the cache's name. Caching is only an optimization,
+        #  so any failure, such as pyarrow not being installed or a column
+        #  feather can't store, just leaves the spreadsheet uncached.
+
+        try:
+            os.makedirs(cdir,exist_ok=True)
+            (fd,t_name) = tempfile.mkstemp(dir=cdir,suffix='.tmp')
+            os.close(fd)
+            try:
+                exo.reset_index().to_feather(t_name)
+                os.replace(t_name,c_name)
+            finally:
+                if os.path.exists(t_name):
+                    os.remove(t_name)
+        except Exception:
+            pass
+
+    #  The model works with periods by position, so check once here that
+    #  they are consecutive and in order rather than sorting them every
+    #  time the model is evaluated
+
+    assert (np.diff(exo.index) == 1).all()
+
+    return exo
+
+#=======================================================================
+#  run_levels(files, roll)
 #
+#  Group simulations so each group depends only on earlier groups
+#=======================================================================
 
-files = os.listdir(idir)
-files = [f for f in files if f.endswith('.xlsx') and f[0]=='r']
+def run_levels(files: list, roll: dict) -> list:
+    """
+    Sort simulations into levels based on rolling dependencies.
 
-if base_only:
-    files = ['r01-baseline.xlsx']
+    Parameters
+    ----------
+    files : list
+        Names of the input files to run.
+    roll : dict
+        Rolling simulation controls from model.toml.
+
+    Returns
+    -------
+    list
+        A list of lists of file names. Runs in the same level are
+        independent and every run comes after the base run it needs.
+    """
+
+    level = {}
+
+    def find_level(f):
+        if f not in level:
+            level[f] = 0
+            run = f[:3]
+            if run in roll:
+                base = roll[run]['base']+'.xlsx'
+                if base in files:
+                    level[f] = 1 + find_level(base)
+        return level[f]
 
+    for f in files:
+        find_level(f)
+
+    n_levels = max(level.values(),default=-1) + 1
+
+    return [[f for f in files if level[f] == n] for n in range(n_levels)]
+
+#=======================================================================
+#  RunLog
 #
-#  Walk through the list of files and run any that don't have results
-#  in the output directory
+#  Log messages for a single run
+#=======================================================================
+
+class RunLog:
+    """
+    Collect the log messages for one run so they can be written as a
+    single block, even when several runs are going at once.
+    """
+
+    def __init__(self):
+        self.entries = []
+
+    def log(self, *args):
+        self.entries.append(args)
+
+    def write(self, ql):
+        for args in self.entries:
+            ql.log(*args)
+
+#=======================================================================
+#  run_one(f, pars)
 #
+#  Run a single simulation and write its results
+#=======================================================================
+
+def run_one(f: str, pars: dict) -> None:
+    """
+    Run the simulation defined by one input file.
+
+    Parameters
+    ----------
+    f : str
+        Name of the input file in the input directory.
+    pars : dict
+        A dictionary of parameters. It is copied before the initial
+        capital stock is set so the caller's dictionary isn't changed.
 
-for f in files:
+    Notes
+    -----
+    Run controls, directories, and any batch solutions are taken from
+    the main program. The function returns without doing anything if
+    the output file already exists and neither force nor base_only is
+    set.
+
+    The iteration counter is kept per thread. When runs are done in
+    parallel each run's log messages are buffered and written to the
+    main log as one block when it finishes, so they don't get mixed
+    together. Otherwise they go straight to the main log.
+    """
+
+    _run.n_it = 0
+
+    if n_jobs == 1:
+        _run_one(f, pars)
+        return
+
+    _run.buffer = RunLog()
+
+    try:
+        _run_one(f, pars)
+    finally:
+        with _log_lock:
+            _run.buffer.write(ql)
+        _run.buffer = None
+
+def _run_one(f: str, pars: dict) -> None:
+    """
+    Do the work for run_one().
+    """
 
     #  Build the output filename
 
@@ -311,19 +1045,25 @@ for f in files:
 
     #  Say what we're doing
 
-    ql.log('Input file',i_name)
+    _run.log('Input file',i_name)
 
     #  See if we've already done this one
 
     if os.path.exists(o_name) and not base_only and not force:
-        ql.log('Output file exists, skipping',o_name)
-        continue
+        _run.log('Output file exists, skipping',o_name)
+        return
 
     #  Nope; read the simulation definition
 
-    exo = pd.read_excel(i_name, index_col='period')
+    if f in exo_batch:
+        exo = exo_batch[f]
+    else:
+        exo = read_exo(i_name)
+
+    #  Set the initial capital value in a copy of the parameters so runs
+    #  executing at the same time don't interfere with each other
 
-    #  Set the initial capital value
+    pars = dict(pars)
 
     run = f[:3]
     if run in roll:
@@ -331,8 +1071,11 @@ for f in files:
         prior = roll[run]['base']
         roll_yrs = roll[run]['year']
         
-        basefile = f'{odir}/{prior}.csv'
-        roll_base = pd.read_csv(basefile,index_col='period')
+        if prior not in roll_base_cache:
+            basefile = f'{odir}/{prior}.csv'
+            roll_base_cache[prior] = pd.read_csv(basefile,index_col='period')
+
+        roll_base = roll_base_cache[prior]
         
         roll_cap0 = roll_base.at[roll_yrs,'cap']
         if 'cap0' in roll[run]:
@@ -346,38 +1089,61 @@ for f in files:
 
     #  Set the initial price guess
 
-    p = pd.Series(index=exo.index,data=p0)
+    p = np.full(len(exo),float(p0))
 
     #  Solve the model if P needs to be endogenous
 
-    n_it = 0
+    if f in p_batch:
 
-    if endog_p:
+        #  Already solved as part of the batch
+
+        (p_sol,fun) = p_batch[f]
+        _run.log('Max absolute miss distance',max(abs(fun)))
+        _run.log('Success',True)
+
+        p = p_sol
+
+    elif endog_p:
+
+        #  Calculate everything that doesn't depend on prices once
+
+        ctx = precompute(exo,pars)
 
         #  If inertial, only solve for the first period
 
         if run in inertial:
-            sol = opt.root(miss_one,p0,args=(exo,pars))
-            ql.log('Max absolute miss distance',abs(sol.fun))
+            sol = solve_one(ctx,pars,p0)
+            _run.log('Max absolute miss distance',abs(sol.fun))
+
+        #  Otherwise solve for all periods. Long horizons use Newton-Krylov
+        #  to avoid building and factoring a dense Jacobian.
 
-        #  Otherwise solve for all periods
+        elif len(p) > krylov_n:
+            M = DiagPreconditioner(p,miss_all(p,ctx,pars),pars)
+            sol = opt.root(miss_all,p,args=(ctx,pars),method='krylov',
+                           options={'fatol':1e-10,
+                                    'jac_options':{'method':'gmres',
+                                                   'inner_M':M}})
+            _run.log('Max absolute miss distance',max(abs(sol.fun)))
 
         else:
-            sol = opt.root(miss_all,p,args=(exo,pars))
-            ql.log('Max absolute miss distance',max(abs(sol.fun)))
+            sol = opt.root(miss_all_jac,p,args=(ctx,pars),
+                           jac=True,method='hybr')
+            _run.log('Max absolute miss distance',max(abs(sol.fun)))
 
         #  Make sure it worked
 
-        ql.log('Success',sol.success)
+        _run.log('Success',sol.success)
 
         assert sol.success
+        assert not np.isnan(sol.x).any()
 
         #  Extract the solution
 
         if run in inertial:
-            p = pd.Series(index=exo.index, data=sol.x[0] )
+            p = np.full(len(exo),sol.x[0])
         else:
-            p = pd.Series( sol.x )
+            p = sol.x
 
     #  Evaluate it the model one more time to get the final solution whether
     #  using exogenous or endogenous prices
@@ -411,7 +1177,11 @@ for f in files:
     #  Done, save the results
     
     d.to_csv(o_name)
-    ql.log('Wrote',o_name)
+    _run.log('Wrote',o_name)
+
+    #  Keep the results in case a later rolling run uses this one as its base
+
+    roll_base_cache[stem] = d
 
     #  Print some summary information if this is the baseline case
 
@@ -427,7 +1197,7 @@ for f in files:
         #  For use with rolling simulations, save the capital stock at year 10
 
         cap10 = d.at[10,'cap']
-        ql.log('Year 10 capital',cap10)
+        _run.log('Year 10 capital',cap10)
 
         #  For reference, calculate the ITC that produces the same investment
         #  incentive as PTC of 10%
@@ -438,7 +1208,146 @@ for f in files:
         i_bench_itc = i_bench_gamma/((r+delta)*pk)
         i_bench_itc = i_bench_itc*(2+i_bench_sub)*i_bench_sub
 
-        ql.log('\nInvestment benchmark ITC and sub',{
+        _run.log('\nInvestment benchmark ITC and sub',{
             'itc':i_bench_itc,
             'sub':i_bench_sub,
             })
+
+#=======================================================================
+#  Main program
+#=======================================================================
+
+#
+#  Read configuration information
+#
+
+with open("model.toml", "rb") as f:
+
+    #  Read the configuration file
+
+    info = tomllib.load(f)
+
+    #  Copy parameters to a new dictionary to keep name space clean
+
+    par_names = ['r','delta','w','pk','elast','scale']
+    pars = {k:info[k] for k in par_names}
+
+    #  Get variables
+
+    p0 = info['p']
+    cap0 = info['cap0']
+
+    #  Get run controls
+
+    endog_p   = info['endog_p']
+    base_only = info['base_only']
+    force     = info['force']
+    n_jobs    = info['n_jobs']
+    krylov_n  = info['krylov_n']
+
+    roll = info['roll']
+    inertial = info['inertial']
+
+    #  Files and directories
+
+    idir  = info['in']
+
+    if endog_p:
+        odir = info['out_en']
+        logname = 'model-en.log'
+    else:
+        odir = info['out_ex']
+        logname = 'model-ex.log'
+
+#
+#  Start the logger
+#
+
+ql = logger(logname)
+
+ql.log('Endogenous price',endog_p)
+
+#
+#  Look for spreadsheets defining simulations. Only try to use files
+#  with names beginning with "r" and ending with ".xlsx". If base_only
+#  is set, only use the baseline file
+#
+
+files = os.listdir(idir)
+files = [f for f in files if f.endswith('.xlsx') and f[0]=='r']
+
+if base_only:
+    files = ['r01-baseline.xlsx']
+
+#
+#  When prices are endogenous, runs that use rational expectations and
+#  the default initial capital stock are independent of one another and
+#  are solved together, with one batch for each set of periods. Rolling
+#  and inertial runs, and any run a batch fails to solve, are solved
+#  individually in the main loop.
+#
+
+exo_batch = {}
+
+if endog_p:
+
+    for f in files:
+
+        (stem,ext) = os.path.splitext(f)
+        o_name = f"{odir}/{stem}.csv"
+
+        run = f[:3]
+        if run in roll or run in inertial:
+            continue
+
+        if os.path.exists(o_name) and not base_only and not force:
+            continue
+
+        exo_batch[f] = read_exo(f"{idir}/{f}")
+
+p_batch = {}
+
+if exo_batch:
+
+    pars['cap0'] = cap0
+
+    #  Runs can only be stacked if they cover the same periods, so solve
+    #  one batch for each distinct set of periods
+
+    groups = {}
+    for (f,exo) in exo_batch.items():
+        groups.setdefault(tuple(exo.index),[]).append(f)
+
+    for group in groups.values():
+
+        exos = [exo_batch[f] for f in group]
+        (P,F,done) = solve_batch(exos,pars,p0)
+
+        for (f,row,fun,ok) in zip(group,P,F,done):
+            if ok:
+                p_batch[f] = (row,fun)
+
+        ql.log('Batch solved',[f for f in group if f in p_batch])
+
+#
+#  Results of base runs for rolling simulations, keyed by stem. Filled in
+#  as runs finish or when a base run's CSV file is first read.
+#
+
+roll_base_cache = {}
+
+#
+#  Walk through the list of files and run any that don't have results
+#  in the output directory. Runs at each level depend only on runs at
+#  earlier levels so they can be done in parallel if n_jobs isn't 1.
+#
+
+for level in run_levels(files,roll):
+
+    if n_jobs == 1:
+        for f in level:
+            run_one(f,pars)
+    else:
+        from joblib import Parallel, delayed
+        Parallel(n_jobs=n_jobs,prefer='threads')(
+            delayed(run_one)(f,pars) for f in level)
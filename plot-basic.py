@@ -64,7 +64,7 @@ def drawplot(include: list, title: str, var1: str, var2: str,
     #  Print a short summary of key data
     #
 
-    ss = normed[ normed['legend'].str[0].isin(include) ]
+    ss = normed[ normed['leg0'].isin(include) ]
     ss = ss.query('period == 0 or period == 100')
     ss = ss[['period','legend','lam','inv','cap']]
     ss = ss.set_index(['legend','period']).unstack().round(2)
@@ -74,7 +74,7 @@ def drawplot(include: list, title: str, var1: str, var2: str,
     #  Trim the data down to the desired runs
     #
 
-    trim = short[ legkey.isin(include) ]
+    trim = short[ short['leg0'].isin(include) ]
 
     #
     #  Draw the plot
@@ -109,6 +109,10 @@ def drawplot(include: list, title: str, var1: str, var2: str,
 
     fig.savefig(fname)
 
+    #  Release the figure so pyplot doesn't keep every plot open
+
+    plt.close(fig)
+
     return fig
 
 #=======================================================================
@@ -178,10 +182,13 @@ for f in files:
 #  Read the data files into a single DataFrame
 #
 
-data = { os.path.splitext(f)[0]: pd.read_csv(f'{odir}/{f}') for f in files }
-data = pd.concat(data)
-data = data.reset_index(0)
-data = data.rename(columns={'level_0':'run'})
+data = []
+for f in files:
+    df = pd.read_csv(f'{odir}/{f}')
+    df['run'] = os.path.splitext(f)[0]
+    data.append(df)
+
+data = pd.concat(data,ignore_index=True)
 
 #
 #  Add legends
@@ -192,20 +199,28 @@ data = data.query("legend != 'omit'")
 data = data.sort_values(['legend','period'])
 data = data.reset_index(drop=True)
 
+#
+#  Store the run names and the legend code letters as categoricals so
+#  filtering runs for each plot compares integer codes
+#
+
+data['run'] = data['run'].astype('category')
+data['leg0'] = data['legend'].str[0].astype('category')
+
 #
 #  Standardize results for plotting
 #
 
 norm =  data.query('run=="r01-baseline" and period==0').iloc[0]
 
-normed = data.copy()
-for k in ['inv','cap','p','q']:
-    normed[k] = 100*normed[k]/norm[k] - 100
+cols = ['inv','cap','p','q']
+
+normed = data
+normed[cols] = 100*normed[cols].to_numpy()/norm[cols].to_numpy(dtype=float) - 100
 
 short = normed.query(f'period <= {last_yr}').copy()
 
 run = short['run']
-legkey = short['legend'].str[0]
 
 #=======================================================================
 #  Draw the plots
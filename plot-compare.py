@@ -34,11 +34,13 @@ def get_files(odir):
 
 def get_data(odir,files):
 
-    data = { os.path.splitext(f)[0]: pd.read_csv(f'{odir}/{f}') for f in files }
+    data = []
+    for f in files:
+        df = pd.read_csv(f'{odir}/{f}')
+        df['run'] = os.path.splitext(f)[0]
+        data.append(df)
 
-    data = pd.concat(data)
-    data = data.reset_index(0)
-    data = data.rename(columns={'level_0':'run'})
+    data = pd.concat(data,ignore_index=True)
 
     data['legend'] = data['run'].replace(legend_mapping)
     data = data.query("legend != 'omit'")
@@ -61,7 +63,7 @@ def drawplot(include,title,grp,run):
     #  Print some summary information
     #
 
-    ss = stack[ stack['legend'].str[0].isin(include) ]
+    ss = stack[ stack['leg0'].isin(include) ]
     ss = ss.query('period == 0 or period == 100')
     ss = ss[['period','legend','lam','inv','cap','Closure']]
     ss = ss.set_index(['legend','Closure','period']).unstack().round(2)
@@ -71,14 +73,14 @@ def drawplot(include,title,grp,run):
     #  Trim the data to the specified runs and rename the legend
     #
 
-    trim = short[ legkey.isin(include) ].copy()
+    trim = short[ short['leg0'].isin(include) ].copy()
     trim = trim.rename(columns={'legend':'Experiment'})
 
     #
     #  Tweak the B legend for clarity
     #
 
-    is_b = trim['Experiment'].str[0] == 'B'
+    is_b = trim['leg0'] == 'B'
 
     if any(is_b):
         trim.loc[is_b,'Experiment'] = "B: ITC, permanent"
@@ -111,16 +113,17 @@ def drawplot(include,title,grp,run):
 
     figname = f'{odir3}/fig{grp}-cmp-A{run}.png'
     fig.savefig(figname)
+    plt.close(fig)
     ql.log('Wrote image',figname)
 
     #
     #  Make a dataframe for plotting expected vs actual prices
     #
 
-    pcomp = trim[['period','Experiment','Closure','p','p_market']]
+    pcomp = trim[['period','Experiment','leg0','Closure','p','p_market']]
 
     pcomp = pcomp.melt(
-        id_vars=['period','Experiment','Closure'],
+        id_vars=['period','Experiment','leg0','Closure'],
         var_name='Type',
         value_name='Price'
         )
@@ -134,7 +137,7 @@ def drawplot(include,title,grp,run):
     #  Fix labeling of Q for clarity
     #
 
-    is_q = pcomp['Experiment'].str[0] == 'Q'
+    is_q = pcomp['leg0'] == 'Q'
 
     if any(is_q & is_en):
         pcomp.loc[is_q,'Experiment'] += ", PF"
@@ -160,6 +163,7 @@ def drawplot(include,title,grp,run):
 
     figname = f'{odir3}/fig{grp}-cmp-A{run}-P.png'
     fig.savefig(figname)
+    plt.close(fig)
     ql.log('Wrote image',figname)
 
 #=======================================================================
@@ -222,14 +226,21 @@ for f in files:
 #  Read the data files into a single DataFrame
 #
 
-data = {
-    'P ex': get_data(odir1,files),
-    'P end': get_data(odir2,files)
-    }
+data = []
+for closure,odir in [('P ex',odir1),('P end',odir2)]:
+    df = get_data(odir,files)
+    df['Closure'] = closure
+    data.append(df)
 
-stack = pd.concat(data)
-stack = stack.reset_index(0)
-stack = stack.rename(columns={'level_0':'Closure'})
+stack = pd.concat(data,ignore_index=True)
+
+#
+#  Store the run names and the legend code letters as categoricals so
+#  filtering runs for each plot compares integer codes
+#
+
+stack['run'] = stack['run'].astype('category')
+stack['leg0'] = stack['legend'].str[0].astype('category')
 
 #
 #  Standardize variables for plotting
@@ -237,14 +248,13 @@ stack = stack.rename(columns={'level_0':'Closure'})
 
 norm =  stack.query('run=="r01-baseline" and period==0').iloc[0]
 
+cols = ['inv','cap','p','q','p_market']
+
 normed = stack.copy()
-for k in ['inv','cap','p','q','p_market']:
-    normed[k] = 100*normed[k]/norm[k] - 100
+normed[cols] = 100*normed[cols].to_numpy()/norm[cols].to_numpy(dtype=float) - 100
 
 short = normed.query(f'period <= {last_yr}').copy()
 
-legkey = short['legend'].str[0]
-
 #========================================================================
 #  Draw the plots
 #========================================================================